@@ -4,10 +4,27 @@ import torch.nn as nn
 import torch.optim as optim
 import numpy as np
 import random
+import copy
+import atexit
 import threading
 import time
 import os
 
+# int8 kernels used by the quantized search model
+if 'x86' in torch.backends.quantized.supported_engines:
+    torch.backends.quantized.engine = 'x86'
+
+# --- Move Ordering ---
+def mvv_lva_score(board, move):
+    # MVV-LVA: capturing the most valuable victim with the least valuable attacker
+    # scores highest (piece types 1-6 double as values), promotions add on top
+    attacker = board.piece_type_at(move.from_square)
+    victim = board.piece_type_at(move.to_square)
+    if victim is None and attacker == chess.PAWN and move.to_square == board.ep_square:
+        victim = chess.PAWN # En passant
+    score = 10 * victim - attacker if victim else 0
+    return score + 10 * (move.promotion or 0)
+
 # --- Neural Network ---
 class ChessNet(nn.Module):
     def __init__(self):
@@ -24,13 +41,85 @@ class ChessNet(nn.Module):
         return x
 
 # --- Engine ---
+# Transposition table flags: how a stored value relates to the true score
+TT_EXACT = 0
+TT_LOWERBOUND = 1 # Search failed high (beta cutoff)
+TT_UPPERBOUND = 2 # No move improved on alpha
+
+def tt_value(value, shift):
+    # Mate scores count plies from the root, in the table they count from the node
+    # (shift by +ply to store, -ply to probe): a transposition may come up at another ply
+    if value > 1.0:
+        return value + shift
+    if value < -1.0:
+        return value - shift
+    return value
+
 class ChessEngine:
-    def __init__(self, model_path="model.pth"):
+    # Position of each (piece type, color) inside a square's 12 slots
+    # Color_Offset: 0 for White, 6 for Black
+    PIECE_OFFSETS = {
+        (piece_type, color): (piece_type - chess.PAWN) + (0 if color == chess.WHITE else 6)
+        for piece_type in chess.PIECE_TYPES
+        for color in chess.COLORS
+    }
+
+    # Deepest search get_move runs (high ELO)
+    MAX_DEPTH = 3
+
+    # Half-width of the window around the previous iteration's value
+    # that iterative deepening searches first
+    ASPIRATION_WINDOW = 0.1
+
+    # Value of a checkmate (negated when White is mated), less one per ply from the root
+    # so a nearer mate wins; well outside the network's tanh output in [-1, 1]
+    MATE_SCORE = 100.0
+
+    # Search model precisions: int8 dynamic quantization, bfloat16 or plain float32
+    PRECISIONS = ("int8", "bf16", "fp32")
+
+    # Rows of the pinned staging buffer and of the CUDA graph input;
+    # a position has at most 218 legal moves
+    MAX_BATCH = 256
+
+    # Fixed batch size the torch.compile'd model is called with (padded chunks),
+    # so Inductor specializes on one shape and never recompiles
+    COMPILE_BATCH = 64
+
+    def __init__(self, model_path="model.pth", precision=None, compile_model=False):
+        # Default precision: int8 on CPU, fp32 on GPU or with torch.compile
+        # (int8 kernels are CPU only and don't go through Inductor)
+        if precision is None:
+            precision = "fp32" if torch.cuda.is_available() or compile_model else "int8"
+        if precision not in self.PRECISIONS:
+            raise ValueError(f"Unknown precision {precision!r}, expected one of {self.PRECISIONS}")
+        if compile_model and precision == "int8":
+            raise ValueError("torch.compile needs a bf16 or fp32 search model, not int8")
         self.model = ChessNet()
         self.model_path = model_path
+        self.precision = precision
+        self.compile_model = compile_model
+        self.inference_model = None
+        self.input_dtype = torch.bfloat16 if precision == "bf16" else torch.float32
+        # The search model runs on the GPU when there is one; self.model trains on the CPU
+        use_cuda = torch.cuda.is_available() and precision != "int8"
+        self.device = torch.device("cuda" if use_cuda else "cpu")
+        if use_cuda:
+            # Leaf batches are staged in pinned memory for async host->device copies
+            self._host_buf = torch.empty(self.MAX_BATCH, 768, pin_memory=True)
+        if use_cuda or compile_model:
+            # Guards the shared GPU buffers, and the compiled model's weights
+            # while they are being refreshed
+            self._infer_lock = threading.Lock()
         self.load_model()
+        self.model.eval() # Inference by default, train_step switches modes itself
+        self.refresh_inference_model()
+        # Per-thread search state: self-play and concurrent /move requests each
+        # get their own transposition table, move lists and buffers
+        self._local = threading.local()
         self.optimizer = optim.Adam(self.model.parameters(), lr=0.001)
         self.criterion = nn.MSELoss()
+        self._save_thread = None
 
     def load_model(self):
         if os.path.exists(self.model_path):
@@ -42,110 +131,347 @@ class ChessEngine:
         else:
             print("No existing model found, starting fresh.")
 
-    def save_model(self):
-        torch.save(self.model.state_dict(), self.model_path)
-        print(f"Model saved to {self.model_path}")
+    def save_model(self, background=False):
+        # Snapshot the weights now, so training can go on while they are written
+        state = {name: tensor.detach().clone() for name, tensor in self.model.state_dict().items()}
+        # One save at a time, they share the temp file
+        if self._save_thread is not None:
+            self._save_thread.join()
+        if not background:
+            self._write_model(state)
+            return
+
+        self._save_thread = threading.Thread(target=self._write_model, args=(state,), daemon=True)
+        self._save_thread.start()
+
+    def _write_model(self, state):
+        # Write to a temp file then rename it over model_path, so an interrupted
+        # save never leaves a truncated model behind
+        tmp_path = self.model_path + ".tmp"
+        try:
+            torch.save(state, tmp_path)
+            os.replace(tmp_path, self.model_path)
+            print(f"Model saved to {self.model_path}")
+        except Exception as e:
+            print(f"Error saving model: {e}")
+
+    def transposition_table(self):
+        # Position key -> (depth, value, flag, best_move), per thread
+        tt = getattr(self._local, "tt", None)
+        if tt is None:
+            tt = self._local.tt = {}
+        return tt
+
+    def encode_buffer(self):
+        # This thread's reusable (MAX_BATCH, 768) encoding buffer and its tensor view
+        buffers = getattr(self._local, "encode_buffer", None)
+        if buffers is None:
+            x = np.zeros((self.MAX_BATCH, 768), dtype=np.float32)
+            buffers = self._local.encode_buffer = (x, torch.from_numpy(x))
+        return buffers
 
     def board_to_tensor(self, board):
-        # Simple representation: 64 squares, 12 piece types
-        # This is a very basic encoding.
-        pieces = [
-            chess.PAWN, chess.KNIGHT, chess.BISHOP, chess.ROOK, chess.QUEEN, chess.KING
-        ]
+        # Owned encoding, safe to keep (e.g. self-play history)
         x = np.zeros(768, dtype=np.float32)
-        
-        for square in chess.SQUARES:
-            piece = board.piece_at(square)
-            if piece:
-                # Calculate index: (Square * 12) + (PieceType_Index + Color_Offset)
-                # Color_Offset: 0 for White, 6 for Black
-                offset = 0 if piece.color == chess.WHITE else 6
-                piece_idx = pieces.index(piece.piece_type)
-                idx = (square * 12) + (piece_idx + offset)
-                x[idx] = 1.0
-        
-        return torch.from_numpy(x).unsqueeze(0) # Add batch dimension
+        self.encode_into(board, x)
+        return torch.from_numpy(x).unsqueeze_(0) # Add batch dimension
+
+    def encode_transient(self, board):
+        # Encoding in this thread's shared buffer, no allocation; only valid
+        # until the next encode on this thread, so use board_to_tensor to keep it
+        x, tensor = self.encode_buffer()
+        x[0].fill(0)
+        self.encode_into(board, x[0])
+        return tensor[:1]
+
+    def encode_into(self, board, x):
+        # Set the ones of board's encoding in x, a zeroed 768 float vector
+        # Simple representation: 64 squares, 12 piece types
+        # Index: (Square * 12) + (PieceType_Index + Color_Offset)
+        # Read straight from the board's bitboards instead of visiting all 64 squares
+        white, black = board.occupied_co[chess.WHITE], board.occupied_co[chess.BLACK]
+
+        for bb_pieces, piece_type in (
+            (board.pawns, chess.PAWN), (board.knights, chess.KNIGHT), (board.bishops, chess.BISHOP),
+            (board.rooks, chess.ROOK), (board.queens, chess.QUEEN), (board.kings, chess.KING),
+        ):
+            for bb, color in ((bb_pieces & white, chess.WHITE), (bb_pieces & black, chess.BLACK)):
+                offset = self.PIECE_OFFSETS[piece_type, color]
+                while bb:
+                    lsb = bb & -bb
+                    x[(lsb.bit_length() - 1) * 12 + offset] = 1.0
+                    bb ^= lsb
+
+    def refresh_inference_model(self):
+        # The search runs a TorchScript (or torch.compile'd) copy of the network
+        # in self.precision; self.model stays in fp32 for train_step. The copy is
+        # a snapshot, so this must be called again after training to pick up new weights.
+        if self.compile_model and self.inference_model is not None:
+            # Compiled code reads the parameters at call time: copy the new
+            # weights in place instead of paying for a recompile.
+            # No search may read them halfway through the copy.
+            with self._infer_lock:
+                self._compiled_source.load_state_dict(self.model.state_dict())
+            return
+
+        if self.precision == "int8":
+            model = torch.ao.quantization.quantize_dynamic(self.model, {nn.Linear}, dtype=torch.qint8)
+        else:
+            model = copy.deepcopy(self.model).to(self.device, self.input_dtype)
+
+        if self.compile_model:
+            self._compiled_source = model
+            inference_model = torch.compile(model, mode="reduce-overhead", dynamic=False)
+        else:
+            inference_model = torch.jit.script(model).eval()
+        self.warm_up(inference_model)
+        if self.device.type == "cuda" and not self.compile_model:
+            # A compiled model gets its CUDA graphs from reduce-overhead instead.
+            # No other batch may run on the GPU while a graph is being captured
+            with self._infer_lock:
+                self._cuda_graph = self.capture_graph(inference_model)
+        self.inference_model = inference_model
+
+    def capture_graph(self, model):
+        # Record one forward pass over a full MAX_BATCH input as a CUDA graph.
+        # evaluate_batch refills the static input and replays it, instead of
+        # launching every kernel again. Warm up on a side stream first, as
+        # capture requires.
+        static_input = torch.zeros(self.MAX_BATCH, 768, dtype=self.input_dtype, device=self.device)
+        with torch.inference_mode():
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream):
+                for _ in range(3):
+                    model(static_input)
+            torch.cuda.current_stream().wait_stream(stream)
+
+            graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(graph):
+                static_output = model(static_input)
+        return graph, static_input, static_output
+
+    def warm_up(self, model):
+        # Run the model so its one-time work happens now, not during the next
+        # /move request: the scripted model on a single position and on a typical
+        # leaf batch (twice each, the profiling executor optimizes on the second
+        # run), the compiled one a few times on its only shape (compilation,
+        # then reduce-overhead's graph recording)
+        batch_sizes = (self.COMPILE_BATCH,) * 3 if self.compile_model else (1, 1, 32, 32)
+        with torch.inference_mode():
+            for batch_size in batch_sizes:
+                model(torch.zeros(batch_size, 768, dtype=self.input_dtype, device=self.device))
 
     def evaluate(self, board):
-        with torch.no_grad():
-            tensor = self.board_to_tensor(board)
-            return self.model(tensor).item()
+        return self.evaluate_batch(self.encode_transient(board))[0]
+
+    def evaluate_batch(self, batch):
+        # One forward pass for a whole (N, 768) batch of positions
+        with torch.inference_mode():
+            if self.compile_model:
+                return self.evaluate_compiled(batch)
+            if self.device.type == "cuda":
+                # The staging buffer and graph input are shared, one batch at a time.
+                # tolist() waits for the result, so both are free again on exit.
+                with self._infer_lock:
+                    graph, static_input, static_output = self._cuda_graph
+                    n = batch.shape[0]
+                    host = self._host_buf[:n]
+                    host.copy_(batch)
+                    static_input[:n].copy_(host, non_blocking=True)
+                    # Rows past n hold stale positions, their outputs are ignored
+                    graph.replay()
+                    return static_output[:n].squeeze(1).tolist()
+            return self.inference_model(batch.to(self.input_dtype)).squeeze(1).tolist()
+
+    def evaluate_compiled(self, batch):
+        # Feed the compiled model fixed COMPILE_BATCH chunks, padded in this
+        # thread's buffer, so it only ever sees the shape it was compiled for.
+        # One batch at a time: on GPU its graph replays share buffers, and
+        # refresh_inference_model updates the weights in place.
+        padded = getattr(self._local, "compile_buffer", None)
+        if padded is None:
+            padded = self._local.compile_buffer = torch.zeros(
+                self.COMPILE_BATCH, 768, dtype=self.input_dtype, device=self.device)
+        values = []
+        for start in range(0, batch.shape[0], self.COMPILE_BATCH):
+            chunk = batch[start:start + self.COMPILE_BATCH]
+            n = chunk.shape[0]
+            # Rows past n hold stale positions, their outputs are ignored
+            padded[:n].copy_(chunk)
+            with self._infer_lock:
+                values.extend(self.inference_model(padded)[:n].squeeze(1).tolist())
+        return values
+
+    def mate_value(self, board, ply):
+        # The side to move is checkmated, ply moves from the root
+        return -(self.MATE_SCORE - ply) if board.turn == chess.WHITE else self.MATE_SCORE - ply
+
+    def evaluate_children(self, board, moves, maximizing_player, ply=0):
+        # Parent of leaves: encode every child and score them all at once,
+        # instead of paying a full forward call per leaf.
+        # Rows are filled in place in this thread's encoding buffer.
+        x, tensor = self.encode_buffer()
+        x[:len(moves)].fill(0)
+        mates = []
+        for i, move in enumerate(moves):
+            board.push(move)
+            self.encode_into(board, x[i])
+            # The network can't see a mate at the horizon, only checks can be one
+            if board.is_check() and not any(board.generate_legal_moves()):
+                mates.append((i, self.mate_value(board, ply + 1)))
+            board.pop()
+
+        values = self.evaluate_batch(tensor[:len(moves)])
+        for i, value in mates:
+            values[i] = value
+        pick = max if maximizing_player else min
+        best = pick(range(len(moves)), key=values.__getitem__)
+        return values[best], moves[best]
 
     def get_move(self, fen, target_elo):
         board = chess.Board(fen)
-        legal_moves = list(board.legal_moves)
-        
-        if not legal_moves:
+        self.transposition_table().clear()
+
+        if not board.legal_moves:
             return None
 
         # ELO Logic
         if target_elo < 1000:
             # Low ELO: High randomness, depth 1
             if random.random() < 0.5:
-                return str(random.choice(legal_moves))
+                return str(random.choice(list(board.legal_moves)))
             depth = 1
         elif target_elo < 1800:
             # Mid ELO: Some randomness, depth 2
             if random.random() < 0.2:
-                return str(random.choice(legal_moves))
+                return str(random.choice(list(board.legal_moves)))
             depth = 2
         else:
             # High ELO: Best move, depth 3 (limited for performance)
-            depth = 3
+            depth = self.MAX_DEPTH
 
+        # Iterative deepening: each depth is searched in a narrow window around the
+        # previous value, and the transposition table's best moves from the
+        # shallower search are tried first at every node
+        maximizing = board.turn == chess.WHITE
         best_move = None
-        best_val = -float('inf') if board.turn == chess.WHITE else float('inf')
+        alpha, beta = -float('inf'), float('inf')
+        for d in range(1, depth + 1):
+            value, move = self.minimax(board, d, alpha, beta, maximizing)
+            if value <= alpha or value >= beta:
+                # Outside the aspiration window: search again with a full window
+                value, move = self.minimax(board, d, -float('inf'), float('inf'), maximizing)
+            best_move = move
+            alpha, beta = value - self.ASPIRATION_WINDOW, value + self.ASPIRATION_WINDOW
 
-        # Simple Minimax (No Alpha-Beta for brevity, but recommended)
-        for move in legal_moves:
-            board.push(move)
-            val = self.minimax(board, depth - 1, -float('inf'), float('inf'), not board.turn)
-            board.pop()
+        return str(best_move) if best_move else str(random.choice(list(board.legal_moves)))
 
-            if board.turn == chess.WHITE:
-                if val > best_val:
-                    best_val = val
-                    best_move = move
+    def generate_moves(self, board, depth):
+        # Fill this thread's move list for the given remaining depth. Each depth
+        # has its own list, reused across nodes instead of allocating one per node;
+        # a node's list stays valid while its children (depth - 1) are searched.
+        move_lists = getattr(self._local, "move_lists", None)
+        if move_lists is None:
+            move_lists = self._local.move_lists = [[] for _ in range(self.MAX_DEPTH + 1)]
+        moves = move_lists[depth]
+        moves.clear()
+        moves.extend(board.generate_legal_moves())
+        return moves
+
+    def order_moves(self, board, moves, tt_move=None):
+        # The transposition table's best move first, then best captures (MVV-LVA)
+        # and promotions, so alpha-beta cutoffs happen early
+        moves.sort(key=lambda m: mvv_lva_score(board, m), reverse=True)
+        if tt_move is not None and tt_move in moves:
+            moves.remove(tt_move)
+            moves.insert(0, tt_move)
+        return moves
+
+    def minimax(self, board, depth, alpha, beta, maximizing_player, ply=0):
+        # Returns (evaluation, best move); the move is None at leaves.
+        # ply: moves played from the root, for mate distances
+        if depth == 0:
+            return self.evaluate(board), None
+
+        # Reuse results from a transposition searched at least as deep
+        alpha_orig, beta_orig = alpha, beta
+        tt = self.transposition_table()
+        key = board._transposition_key()
+        hit = tt.get(key)
+        if hit is not None and hit[0] >= depth:
+            _, value, flag, move = hit
+            value = tt_value(value, -ply)
+            if flag == TT_EXACT:
+                return value, move
+            elif flag == TT_LOWERBOUND:
+                alpha = max(alpha, value)
             else:
-                if val < best_val:
-                    best_val = val
-                    best_move = move
-        
-        return str(best_move) if best_move else str(random.choice(legal_moves))
+                beta = min(beta, value)
+            if beta <= alpha:
+                return value, move
 
-    def minimax(self, board, depth, alpha, beta, maximizing_player):
-        if depth == 0 or board.is_game_over():
-            return self.evaluate(board)
+        best_move = None
+        tt_move = hit[3] if hit is not None else None # Best move of a shallower search, tried first
+        moves = self.generate_moves(board, depth)
+        if not moves:
+            # Game over, found from the move generation this node needs anyway
+            # instead of a separate board.is_game_over() at every node
+            if board.is_check():
+                return self.mate_value(board, ply), None
+            return 0.0, None # Stalemate
 
-        if maximizing_player:
+        if depth == 1:
+            best_val, best_move = self.evaluate_children(board, moves, maximizing_player, ply)
+        elif maximizing_player:
             max_eval = -float('inf')
-            for move in board.legal_moves:
+            for move in self.order_moves(board, moves, tt_move):
                 board.push(move)
-                eval = self.minimax(board, depth - 1, alpha, beta, False)
+                eval, _ = self.minimax(board, depth - 1, alpha, beta, False, ply + 1)
                 board.pop()
-                max_eval = max(max_eval, eval)
+                if eval > max_eval:
+                    max_eval = eval
+                    best_move = move
                 alpha = max(alpha, eval)
                 if beta <= alpha:
                     break
-            return max_eval
+            best_val = max_eval
         else:
             min_eval = float('inf')
-            for move in board.legal_moves:
+            for move in self.order_moves(board, moves, tt_move):
                 board.push(move)
-                eval = self.minimax(board, depth - 1, alpha, beta, True)
+                eval, _ = self.minimax(board, depth - 1, alpha, beta, True, ply + 1)
                 board.pop()
-                min_eval = min(min_eval, eval)
+                if eval < min_eval:
+                    min_eval = eval
+                    best_move = move
                 beta = min(beta, eval)
                 if beta <= alpha:
                     break
-            return min_eval
+            best_val = min_eval
+
+        if best_val <= alpha_orig:
+            flag = TT_UPPERBOUND
+        elif best_val >= beta_orig:
+            flag = TT_LOWERBOUND
+        else:
+            flag = TT_EXACT
+        tt[key] = (depth, tt_value(best_val, ply), flag, best_move)
+        return best_val, best_move
 
     def train_step(self, board_tensor, target_val):
+        return self.train_batch(board_tensor, torch.tensor([[target_val]], dtype=torch.float32))
+
+    def train_batch(self, X, Y):
+        # One optimizer step on a (N, 768) batch of positions and (N, 1) targets.
+        # X must not come from inside inference_mode, autograd can't use it
+        self.model.train()
         self.optimizer.zero_grad()
-        output = self.model(board_tensor)
-        loss = self.criterion(output, torch.tensor([[target_val]], dtype=torch.float32))
+        output = self.model(X)
+        loss = self.criterion(output, Y)
         loss.backward()
         self.optimizer.step()
+        self.model.eval()
         return loss.item()
 
 # --- Self Training ---
@@ -153,10 +479,23 @@ class SelfTrainer:
     def __init__(self, engine):
         self.engine = engine
         self.running = True
+        self.games_since_save = 0
+        self.save_every = 25 # Games between two saves of the model to disk
         self.thread = threading.Thread(target=self.loop, daemon=True)
 
     def start(self):
         self.thread.start()
+        # On shutdown, stop training first, then save the games played since the last save
+        atexit.register(self.stop)
+
+    def stop(self):
+        # Wait for the self-play thread, so the weights aren't saved halfway through a step
+        self.running = False
+        if self.thread.is_alive():
+            self.thread.join()
+        if self.games_since_save > 0:
+            self.engine.save_model()
+            self.games_since_save = 0
 
     def loop(self):
         print("Self-training started...")
@@ -172,7 +511,7 @@ class SelfTrainer:
         board = chess.Board()
         game_history = []
         
-        while not board.is_game_over():
+        while self.running and not board.is_game_over():
             # Self-play uses some randomness to explore
             if random.random() < 0.1:
                 move = random.choice(list(board.legal_moves))
@@ -184,7 +523,10 @@ class SelfTrainer:
             # Store state for training
             game_history.append((self.engine.board_to_tensor(board), board.turn))
             board.push(move)
-        
+
+        if not self.running:
+            return # Stopped mid-game, nothing to learn from it
+
         # Game over, determine reward
         result = board.result()
         if result == "1-0":
@@ -199,14 +541,24 @@ class SelfTrainer:
         # Actually, if White won (1.0), White positions should evaluate to 1.0, Black to -1.0?
         # Let's simplify: Winner's positions -> 1.0, Loser's -> -1.0
         
+        targets = []
         for tensor, turn in game_history:
             target = reward
             # If it was Black's turn and White won (reward=1), this position was bad for Black?
             # Or rather, the evaluation is always from White's perspective.
             # So if White won, all positions should ideally eval to 1.0.
-            
-            self.engine.train_step(tensor, target)
-        
-        self.engine.save_model()
+            targets.append(target)
+
+        # Train on the whole game as one batch: one forward/backward/step
+        # instead of one per position
+        X = torch.cat([tensor for tensor, _ in game_history])
+        Y = torch.tensor(targets, dtype=torch.float32).unsqueeze(1)
+        self.engine.train_batch(X, Y)
+
+        self.engine.refresh_inference_model()
+        self.games_since_save += 1
+        if self.games_since_save >= self.save_every:
+            self.engine.save_model(background=True)
+            self.games_since_save = 0
         print(f"Self-play game finished. Result: {result}")
 
@@ -10,7 +10,12 @@ app = Flask(__name__)
 CORS(app) # Enable CORS for all routes
 
 # Initialize Engine
-engine = ChessEngine()
+# MODEL_PRECISION picks the search model format: int8, bf16 or fp32
+# (defaults to int8 on CPU and fp32 on GPU or with TORCH_COMPILE=1)
+engine = ChessEngine(
+    precision=os.environ.get("MODEL_PRECISION"),
+    compile_model=os.environ.get("TORCH_COMPILE") == "1",
+)
 trainer = SelfTrainer(engine)
 
 # --- Background Tasks ---
@@ -18,17 +23,17 @@ def start_background_tasks():
     # 1. Self Training
     trainer.start()
 
-    # 2. Keep Alive
+    # 2. Keep Alive (only Render spins down an idle service, nothing to keep awake locally)
+    external_url = os.environ.get("RENDER_EXTERNAL_URL")
+    if not external_url:
+        return
+
     def keep_alive():
         while True:
             time.sleep(14 * 60) # 14 minutes
             try:
-                # Replace with your actual Render URL in production
-                url = "http://localhost:5000/ping" 
-                if os.environ.get("RENDER_EXTERNAL_URL"):
-                    url = os.environ.get("RENDER_EXTERNAL_URL") + "/ping"
-                
-                requests.get(url)
+                # Render only counts traffic through its proxy, so this one has to be HTTP
+                requests.get(external_url + "/ping", timeout=10)
                 print("Keep-alive ping sent.")
             except Exception as e:
                 print(f"Keep-alive failed: {e}")
@@ -36,8 +41,10 @@ def start_background_tasks():
     keep_alive_thread = threading.Thread(target=keep_alive, daemon=True)
     keep_alive_thread.start()
 
-# Start threads only if not in reloader mode (to avoid duplicates during dev)
-if os.environ.get("WERKZEUG_RUN_MAIN") == "true" or os.environ.get("RENDER"):
+# Start threads only if not in reloader mode (to avoid duplicates during dev).
+# Under gunicorn they are started in the worker by gunicorn.conf.py (post_fork),
+# threads started here would stay behind in the preloading master process.
+if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
     start_background_tasks()
 
 # --- Routes ---
@@ -0,0 +1,29 @@
+# Gunicorn settings for the backend (also picked up automatically from this directory)
+import os
+
+# Ask torch to look for GPUs through NVML: the default check initializes
+# CUDA in this master process, and a forked worker couldn't use it anymore
+os.environ.setdefault("PYTORCH_NVML_BASED_CUDA_CHECK", "1")
+import torch
+
+# A single worker owns the model and its self-training;
+# threads serve concurrent /move requests with the same engine
+workers = 1
+threads = 4
+
+# Load the app (and the model) once in the master before forking.
+# A CUDA context doesn't survive fork, so GPU machines load in the worker.
+preload_app = not torch.cuda.is_available()
+
+def post_fork(server, worker):
+    from app import engine, start_background_tasks
+
+    if server.cfg.preload_app:
+        # A restarted worker is forked from the startup engine,
+        # pick up the weights self-training saved since then
+        # (without preload the worker just built its own engine)
+        engine.load_model()
+        engine.refresh_inference_model()
+
+    # Threads don't survive fork, start self-training and keep-alive here
+    start_background_tasks()